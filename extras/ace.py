@@ -1,6 +1,41 @@
-import serial, time, logging, json, struct, queue, traceback # type: ignore
+import serial, time, logging, json, struct, queue, traceback, os, re, collections # type: ignore
 from datetime import datetime
 
+# Matches `T<n>` and `ACE_CHANGE_TOOL TOOL=<n>` lines, case-insensitive like
+# Klipper commands. Anchoring on the newline byte rather than `^` with
+# re.MULTILINE keeps scans of large files fast
+_TOOLCHANGE_RE = re.compile(
+    rb'\n[ \t]*(?:[Tt](\d+)|(?i:ACE_CHANGE_TOOL[ \t]+TOOL=)(-?\d+))[ \t]*(?:;[^\n]*)?\r?(?=\n)')
+_SCAN_CHUNK_SIZE = 1 << 20
+# Longer lines (inline thumbnails, binary blobs) cannot be toolchanges and are not carried over
+_MAX_TOOLCHANGE_LINE = 4096
+
+def iter_toolchanges(path, on_chunk=None):
+    # Stream the file in fixed size chunks so memory stays constant. Each
+    # chunk keeps the newline preceding its first line so the pattern matches.
+    # on_chunk is called before each chunk is scanned so the caller can yield
+    tail = b'\n'
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(_SCAN_CHUNK_SIZE)
+            if not chunk:
+                break
+            if on_chunk is not None:
+                on_chunk()
+            chunk = tail + chunk
+            cut = chunk.rfind(b'\n')
+            if cut < 0:
+                # Still inside an overlong line
+                tail = b''
+                continue
+            tail = chunk[cut:]
+            if len(tail) > _MAX_TOOLCHANGE_LINE:
+                tail = b''
+            for m in _TOOLCHANGE_RE.finditer(chunk, 0, cut + 1):
+                yield int(m.group(1) or m.group(2))
+    for m in _TOOLCHANGE_RE.finditer(tail + b'\n'):
+        yield int(m.group(1) or m.group(2))
+
 class PeekableQueue(queue.Queue):
     def peek(self):
         with self.mutex:  # 使用内部锁保证线程安全
@@ -8,6 +43,103 @@ class PeekableQueue(queue.Queue):
                 return None
             return self.queue[0]
 
+class LinkHealth:
+    # Upper bounds (ms) of the round trip time histogram buckets, the last bucket is open ended
+    RTT_BUCKETS = (5, 10, 20, 50, 100, 200, 500, 1000)
+    EWMA_ALPHA = 0.1
+    MIN_SAMPLES = 20
+    # Number of most recent requests the error rate is computed over
+    ERROR_WINDOW = 50
+    # Consecutive proactive reconnects that did not help before giving up
+    MAX_INEFFECTIVE_RECONNECTS = 3
+
+    def __init__(self, max_latency, max_error_rate):
+        self.max_latency = max_latency
+        self.max_error_rate = max_error_rate
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.histogram = [0] * (len(self.RTT_BUCKETS) + 1)
+        self.max_rtt = 0.
+        self.errors = {'write': 0, 'read': 0, 'mismatch': 0}
+        self.reconnects = 0
+        self.proactive_reconnects = 0
+        self.ineffective_reconnects = 0
+        self.flushes = 0
+        self.avg_rtt = 0.
+        self.restart_window()
+
+    def restart_rtt(self):
+        # A reopened or flushed port needs fresh round trip samples. The error
+        # window is kept so a link that keeps dropping frames still shows up
+        self.rtt_samples = 0
+
+    def restart_window(self):
+        # Forget both trends, used after a proactive flush or reconnect to judge its effect
+        self.restart_rtt()
+        self._outcomes = collections.deque(maxlen=self.ERROR_WINDOW)
+        self._window_errors = 0
+
+    def _record_outcome(self, error):
+        if len(self._outcomes) == self._outcomes.maxlen:
+            self._window_errors -= self._outcomes[0]
+        self._outcomes.append(error)
+        self._window_errors += error
+
+    @property
+    def error_rate(self):
+        if not self._outcomes:
+            return 0.
+        return self._window_errors / len(self._outcomes)
+
+    def record_rtt(self, rtt):
+        ms = rtt * 1000.
+        self.requests += 1
+        self.max_rtt = max(self.max_rtt, ms)
+        for i, bound in enumerate(self.RTT_BUCKETS):
+            if ms <= bound:
+                self.histogram[i] += 1
+                break
+        else:
+            self.histogram[-1] += 1
+
+        if self.rtt_samples == 0:
+            self.avg_rtt = ms
+        else:
+            self.avg_rtt += self.EWMA_ALPHA * (ms - self.avg_rtt)
+        self.rtt_samples += 1
+        self._record_outcome(False)
+
+    def record_error(self, kind):
+        self.requests += 1
+        self.errors[kind] += 1
+        self._record_outcome(True)
+
+    def judged(self):
+        return len(self._outcomes) >= self.MIN_SAMPLES
+
+    def degraded(self):
+        slow = self.rtt_samples >= self.MIN_SAMPLES and self.avg_rtt > self.max_latency
+        failing = self.judged() and self.error_rate > self.max_error_rate
+        return slow or failing
+
+    def get_status(self):
+        buckets = ['<=%dms' % b for b in self.RTT_BUCKETS] + ['>%dms' % self.RTT_BUCKETS[-1]]
+        return {
+            'requests': self.requests,
+            'rtt_histogram': dict(zip(buckets, self.histogram)),
+            'avg_rtt': round(self.avg_rtt, 2),
+            'max_rtt': round(self.max_rtt, 2),
+            'error_rate': round(self.error_rate, 3),
+            'errors': dict(self.errors),
+            'reconnects': self.reconnects,
+            'flushes': self.flushes,
+            'proactive_reconnects': self.proactive_reconnects,
+            'ineffective_reconnects': self.ineffective_reconnects,
+            'degraded': self.degraded(),
+        }
+
 class KDragonACE:
     def __init__(self, config):
         self.printer = config.get_printer()
@@ -27,6 +159,9 @@ class KDragonACE:
         self.toolchange_retract_length = config.getint('toolchange_retract_length', 100)
         self.max_dryer_temperature = config.getint('max_dryer_temperature', 55)
         self.disable_assist_after_toolchange = config.getboolean('disable_assist_after_toolchange', False)
+        link_max_latency = config.getfloat('link_max_latency', 200., above=0.)
+        link_max_error_rate = config.getfloat('link_max_error_rate', 0.2, minval=0., maxval=1.)
+        self.link_reconnect_cooldown = config.getfloat('link_reconnect_cooldown', 60., minval=0.)
 
         self._callback_map = {}
         self.park_hit_count = 5
@@ -38,8 +173,18 @@ class KDragonACE:
         self._park_previous_tool = -1
         self._park_index = -1
 
+        self._link_health = LinkHealth(link_max_latency, link_max_error_rate)
+        self._last_proactive_reconnect = 0.
+        # Proactive action ('flush' or 'reconnect') whose effect is judged at the next check
+        self._proactive_action = None
+        self._last_frame_time = 0.
+
         self._last_get_ace_response_time = None
 
+        # Measured toolchange phase durations: phase -> [count, total seconds]
+        self._toolchange_timings = {'reject': [0, 0.], 'feed': [0, 0.], 'park': [0, 0.]}
+        self._last_toolchange_estimate = None
+
         # Default data to prevent exceptions
         self._info = {
             'status': 'ready',
@@ -125,6 +270,12 @@ class KDragonACE:
         self.gcode.register_command(
             'ACE_CLEAR_ALL_STATUS', self.cmd_ACE_CLEAR_ALL_STATUS,
             desc=self.cmd_ACE_CLEAR_ALL_STATUS_help)
+        self.gcode.register_command(
+            'ACE_ESTIMATE_TOOLCHANGES', self.cmd_ACE_ESTIMATE_TOOLCHANGES,
+            desc=self.cmd_ACE_ESTIMATE_TOOLCHANGES_help)
+        self.gcode.register_command(
+            'ACE_LINK_STATUS', self.cmd_ACE_LINK_STATUS,
+            desc=self.cmd_ACE_LINK_STATUS_help)
         self.gcode.register_command(
             'ACE_DEBUG', self.cmd_ACE_DEBUG,
             desc=self.cmd_ACE_DEBUG_help)
@@ -145,6 +296,8 @@ class KDragonACE:
             raise ValueError('ACE: Failed to connect to ' + self.serial_name)
 
         logging.info('ACE: Connected to ' + self.serial_name)
+        # The initial connection is not a reconnect
+        self._link_health.reset()
 
         self._queue = PeekableQueue()
         self.serial_timer = self.reactor.register_timer(self._serial_read_write, self.reactor.NOW)
@@ -234,6 +387,8 @@ class KDragonACE:
                                         baudrate=self.baud)
             if self._serial.isOpen():
                 self._connected = True
+                self._link_health.reconnects += 1
+                self._link_health.restart_rtt()
 
                 if self._feed_assist_index != -1:
                     self._enable_feed_assist(self._feed_assist_index)
@@ -294,6 +449,9 @@ class KDragonACE:
             logging.info(f'[ACE] Read Too short')
             return None
 
+        # Round trip ends here, before the response callback runs
+        self._last_frame_time = self.reactor.monotonic()
+
         if data[0:2] != b"\xFF\xAA":
             logging.info(f'[ACE] Read invalid header')
             return None
@@ -348,17 +506,72 @@ class KDragonACE:
 
         return id
 
+    def _check_link_health(self):
+        # Called at the start of a toolchange, where reopening the port and
+        # re-enabling feed assist cannot pause a print in progress
+        health = self._link_health
+        if not health.judged():
+            return
+
+        degraded = health.degraded()
+        action = self._proactive_action
+        self._proactive_action = None
+        if action == 'reconnect' and degraded:
+            health.ineffective_reconnects += 1
+            if health.ineffective_reconnects == health.MAX_INEFFECTIVE_RECONNECTS:
+                self.gcode.respond_info('[ACE] Serial link still degraded after ' + str(health.ineffective_reconnects)
+                                        + ' reconnects, check the USB cable and hub')
+
+        if not degraded:
+            health.ineffective_reconnects = 0
+            return
+        if health.ineffective_reconnects >= health.MAX_INEFFECTIVE_RECONNECTS:
+            return
+
+        if action is None and health.ineffective_reconnects == 0:
+            # Stale bytes in the buffers cause mismatched replies, try flushing before reopening
+            self.gcode.respond_info('[ACE] Serial link degraded, flushing: ' + json.dumps(health.get_status()))
+            try:
+                self._serial.reset_input_buffer()
+                self._serial.reset_output_buffer()
+            except Exception as e:
+                logging.warning(f'[ACE] flush error: {e}')
+            health.flushes += 1
+            health.restart_window()
+            self._proactive_action = 'flush'
+            return
+
+        # Back off when earlier reconnects did not bring the link back
+        now = self.reactor.monotonic()
+        cooldown = self.link_reconnect_cooldown * (2 ** health.ineffective_reconnects)
+        if now - self._last_proactive_reconnect < cooldown:
+            return
+
+        self._last_proactive_reconnect = now
+        health.proactive_reconnects += 1
+        self.gcode.respond_info('[ACE] Serial link degraded, reconnecting: ' + json.dumps(health.get_status()))
+
+        self._connected = False
+        self._reconnect_serial()
+        health.restart_window()
+        self._proactive_action = 'reconnect'
+
     def _serial_read_write(self, eventtime):
         if self._connected:
+            start = self.reactor.monotonic()
             send_id = self._writer()
             if None == send_id:
+                self._link_health.record_error('write')
                 self._connected = False
                 return eventtime + 1
 
             read_id = self._reader()
             if read_id != send_id:
+                self._link_health.record_error('read' if read_id is None else 'mismatch')
                 self._connected = False
                 return eventtime + 1
+
+            self._link_health.record_rtt(self._last_frame_time - start)
         else:
             self._reconnect_serial()
             return eventtime + 1
@@ -393,6 +606,18 @@ class KDragonACE:
         self.toolhead.move(pos, speed)
         return pos[3]
 
+    def _record_phase(self, phase, start):
+        # Phases are timed in print time, dwells and moves only queue work on the toolhead
+        timing = self._toolchange_timings[phase]
+        timing[0] += 1
+        timing[1] += self.toolhead.get_last_move_time() - start
+
+    def _phase_time(self, phase, default):
+        count, total = self._toolchange_timings[phase]
+        if count == 0:
+            return default
+        return total / count
+
     def _create_mmu_sensor(self, config, pin, name):
         section = 'filament_switch_sensor %s' % name
         config.fileconfig.add_section(section)
@@ -619,18 +844,12 @@ class KDragonACE:
                 self.gcode.run_script_from_command('_ACE_ON_EMPTY_ERROR INDEX=' + str(tool))
                 return
 
+        self._check_link_health()
+
         self.gcode.run_script_from_command('_ACE_PRE_TOOLCHANGE FROM=' + str(was) + ' TO=' + str(tool))
 
         logging.info('ACE: Toolchange ' + str(was) + ' => ' + str(tool))
-        if was != -1:
-            self._reject_tool(was)
-
-        if tool != -1:
-            self._feed(tool, self.toolchange_retract_length-5, self.retract_speed)
-            self.variables['ace_filament_pos'] = 'bowden'
-            self.wait_ace_ready()
-
-            self._park_to_toolhead(tool)
+        self._change_tool(was, tool)
 
         self.gcode.run_script_from_command('_ACE_POST_TOOLCHANGE FROM=' + str(was) + ' TO=' + str(tool))
 
@@ -642,6 +861,23 @@ class KDragonACE:
 
         gcmd.respond_info(f'Tool {tool} load')
 
+    def _change_tool(self, was, tool):
+        if was != -1:
+            start = self.toolhead.get_last_move_time()
+            self._reject_tool(was)
+            self._record_phase('reject', start)
+
+        if tool != -1:
+            start = self.toolhead.get_last_move_time()
+            self._feed(tool, self.toolchange_retract_length-5, self.retract_speed)
+            self.variables['ace_filament_pos'] = 'bowden'
+            self.wait_ace_ready()
+            self._record_phase('feed', start)
+
+            start = self.toolhead.get_last_move_time()
+            self._park_to_toolhead(tool)
+            self._record_phase('park', start)
+
 
     cmd_ACE_FILAMENT_STATUS_help = 'ACE Filament status'
     def cmd_ACE_FILAMENT_STATUS(self, gcmd):
@@ -660,6 +896,107 @@ class KDragonACE:
             state = 'ACE>>>>>>>>>>|*--|Ex--|*--|Nz--'
         gcmd.respond_info(state)
 
+    cmd_ACE_ESTIMATE_TOOLCHANGES_help = 'Estimate ACE toolchange time and filament usage of a G-code file'
+    def cmd_ACE_ESTIMATE_TOOLCHANGES(self, gcmd):
+        filename = gcmd.get('FILENAME')
+        was = gcmd.get_int('START', self.variables.get('ace_current_index', -1))
+
+        print_stats = self.printer.lookup_object('print_stats', None)
+        if print_stats is not None and print_stats.get_status(self.reactor.monotonic())['state'] in ('printing', 'paused'):
+            raise gcmd.error('Cannot estimate toolchanges while printing')
+
+        if not os.path.isabs(filename):
+            sdcard = self.printer.lookup_object('virtual_sdcard', None)
+            if sdcard is None:
+                raise gcmd.error('virtual_sdcard is required for relative file names')
+            filename = os.path.join(sdcard.sdcard_dirname, filename.lstrip('/'))
+
+        # Phases not measured yet fall back to the fixed dwells the toolchange issues. They leave out
+        # CUT_TIP and the sensor driven loops, so such an estimate is nominal and only a lower bound.
+        # The toolchange feed runs at retract_speed, not feed_speed, so the estimate does too
+        nominal = [k for k, (count, total) in self._toolchange_timings.items() if count == 0]
+        reject_time = self._phase_time('reject', 0.3 + self.toolchange_retract_length / self.retract_speed + 0.1)
+        feed_time = self._phase_time('feed', (self.toolchange_retract_length - 5) / self.retract_speed + 0.1)
+        park_time = self._phase_time('park', 0.7)
+
+        swaps = 0
+        total_time = 0.
+        slots = {}
+        # Yield to the reactor between chunks so heaters and the serial heartbeat keep running
+        def on_chunk():
+            self.reactor.pause(self.reactor.monotonic() + .001)
+
+        try:
+            for tool in iter_toolchanges(filename, on_chunk):
+                if tool == was:
+                    continue
+                if was != -1:
+                    total_time += reject_time
+                    slots.setdefault(was, {'loads': 0, 'retracted': 0, 'fed': 0})
+                    slots[was]['retracted'] += self.toolchange_retract_length
+                if tool != -1:
+                    total_time += feed_time + park_time
+                    slots.setdefault(tool, {'loads': 0, 'retracted': 0, 'fed': 0})
+                    slots[tool]['loads'] += 1
+                    slots[tool]['fed'] += self.toolchange_retract_length - 5
+                swaps += 1
+                was = tool
+        except (IOError, OSError) as e:
+            raise gcmd.error('Unable to read %s: %s' % (filename, e))
+
+        warnings = []
+        for index in sorted(slots):
+            if index < 0 or index >= len(self._info['slots']):
+                warnings.append(f'T{index} has no ACE slot')
+                continue
+            slot = self._info['slots'][index]
+            if slot.get('status', 'empty') == 'empty' or not slot.get('type'):
+                warnings.append(f'T{index} has no material loaded')
+
+        self._last_toolchange_estimate = {
+            'filename': filename,
+            'swaps': swaps,
+            'total_time': round(total_time, 1),
+            'nominal_phases': nominal,
+            'slots': {str(k): v for k, v in slots.items()},
+            'warnings': warnings,
+        }
+
+        msg = f'ACE: {swaps} toolchanges, estimated {total_time:.0f}s'
+        if nominal:
+            msg += ' (nominal, lower bound)'
+        for index in sorted(slots):
+            slot = slots[index]
+            msg += f"\nT{index}: {slot['loads']} loads, fed {slot['fed']}mm, retracted {slot['retracted']}mm"
+        if nominal:
+            msg += '\nWarning: no measured timings for ' + ', '.join(nominal)
+        for warning in warnings:
+            msg += '\nWarning: ' + warning
+        gcmd.respond_info(msg)
+
+    def get_status(self, eventtime):
+        return {
+            'toolchange_timings': {k: self._phase_time(k, 0.) for k in self._toolchange_timings},
+            'toolchange_estimate': self._last_toolchange_estimate,
+            'link': self._link_health.get_status(),
+        }
+
+    cmd_ACE_LINK_STATUS_help = 'Report ACE serial link health'
+    def cmd_ACE_LINK_STATUS(self, gcmd):
+        if gcmd.get_int('RESET', 0):
+            self._link_health.reset()
+            self._proactive_action = None
+            self._last_proactive_reconnect = 0.
+
+        status = self._link_health.get_status()
+        msg = f"ACE link: {status['requests']} requests, avg rtt {status['avg_rtt']}ms, max rtt {status['max_rtt']}ms"
+        msg += f"\nRTT histogram: {status['rtt_histogram']}"
+        msg += f"\nErrors: {status['errors']}, error rate {status['error_rate']}"
+        msg += f"\nReconnects: {status['reconnects']}, proactive: {status['proactive_reconnects']}, flushes: {status['flushes']}"
+        if status['degraded']:
+            msg += '\nWarning: link degraded'
+        gcmd.respond_info(msg)
+
     cmd_ACE_DEBUG_help = 'ACE Debug'
     def cmd_ACE_DEBUG(self, gcmd):
         method = gcmd.get('METHOD')